@@ -4,9 +4,16 @@ import time
 from pathlib import Path
 
 from fire import Fire
-from tqdm import tqdm
 
-from utils import FernetEncoder, GitRepo, Config, Synchronizer
+from utils import (
+    StreamEncoder,
+    GitRepo,
+    Config,
+    FolderWatcher,
+    Synchronizer,
+    SivEncoder,
+    sync_filesystem,
+)
 
 
 def main(path_config: str = "config.json"):
@@ -15,7 +22,8 @@ def main(path_config: str = "config.json"):
 
     git = GitRepo(root=config.path_drive)
     git.clone(config.repo_drive)
-    encoder = FernetEncoder(key=config.encode_key)
+    text_encoder = StreamEncoder(key=config.encode_key)
+    path_encoder = SivEncoder(key=config.encode_key)
     path_drive = Path(config.path_drive).resolve()
     synchronizers = []
 
@@ -27,27 +35,33 @@ def main(path_config: str = "config.json"):
                 patterns=f.file_patterns,
                 folder_in=folder_in,
                 folder_out=folder_out,
-                text_encoder=encoder,
-                path_encoder=encoder,
+                text_encoder=text_encoder,
+                path_encoder=path_encoder,
                 validate_encoding=True,
+                path_cache=path_drive / ".git" / "git-sync" / f"{folder_in.name}.json",
             )
         )
 
-    for _ in tqdm(range(int(1e6))):
+    watcher = FolderWatcher(folders=[s.folder_in for s in synchronizers])
+    is_pending = True
+    while True:
+        is_pending = watcher.wait(config.update_interval) or is_pending
+        if not is_pending:
+            continue
         try:
             for s in synchronizers:
                 s.run()
 
             git.add([path_drive])
             if git.diff_staged():
+                sync_filesystem(path_drive)
                 git.commit(message="Sync")
                 git.push()
+            is_pending = False
         except AssertionError as e:
             print(e)
             time.sleep(60)
 
-        time.sleep(config.update_interval)
-
 
 if __name__ == "__main__":
     Fire(main)
@@ -1,21 +1,70 @@
-import hashlib
+import base64
+import binascii
+import ctypes
+import io
+import json
+import multiprocessing
 import os
+import re
 import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Set, Dict
-
-from cryptography.fernet import Fernet
+from typing import List, Set, Dict, Optional, Tuple, Callable, Union, BinaryIO, Pattern
+
+import blake3
+import pygit2
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESSIV, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.hmac import HMAC
 from fire import Fire
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # Not on Linux, fall back to polling
+    INotify = None
+
+PROCESS_POOL_SIZE = 1 << 24
+STREAM_MAGIC = b"\x00gs1"
 
 
 class Encoder(BaseModel):
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.setup()
+
+    def setup(self):
+        pass
+
+    def __getstate__(self):
+        # Cipher objects can't be pickled, so workers rebuild them from the key
+        return {**super().__getstate__(), "__private_attribute_values__": {}}
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.setup()
+
     def run(self, contents: List[bytes]) -> List[bytes]:
         raise NotImplementedError
 
     def inverse(self, contents: List[bytes]) -> List[bytes]:
         raise NotImplementedError
 
+    def check_round_trip(self, content: bytes):
+        assert self.inverse(self.run([content])) == [content]
+
+    def run_file(self, path_in: Path, path_out: Path):
+        write_path(path_out, self.run([read_path(path_in)])[0])
+
+    def inverse_file(self, path_in: Path, path_out: Path):
+        write_path(path_out, self.inverse([read_path(path_in)])[0])
+
 
 class ReversedEncoder(Encoder):
     encoder: Encoder
@@ -26,19 +75,180 @@ class ReversedEncoder(Encoder):
     def inverse(self, contents: List[bytes]) -> List[bytes]:
         return self.encoder.run(contents)
 
+    def check_round_trip(self, content: bytes):
+        self.encoder.check_round_trip(content)
+
+    def run_file(self, path_in: Path, path_out: Path):
+        self.encoder.inverse_file(path_in, path_out)
+
+    def inverse_file(self, path_in: Path, path_out: Path):
+        self.encoder.run_file(path_in, path_out)
+
 
 class FernetEncoder(Encoder):
+    # Fernet token format, with the signing/encryption keys set up once per encoder
     key: str
+    _aes: algorithms.AES = PrivateAttr()
+    _hmac: HMAC = PrivateAttr()
+
+    def setup(self):
+        key = base64.urlsafe_b64decode(self.key.encode())
+        assert len(key) == 32
+        self._hmac = HMAC(key[:16], hashes.SHA256())
+        self._aes = algorithms.AES(key[16:])
 
     def run(self, contents: List[bytes]) -> List[bytes]:
-        f = Fernet(self.key.encode())
-        encoded = [f.encrypt(c) for c in contents]
-        assert self.inverse(encoded) == contents
+        timestamp = int(time.time()).to_bytes(length=8, byteorder="big")
+        encoded = []
+        for c in contents:
+            iv = os.urandom(16)
+            padder = padding.PKCS7(128).padder()
+            encryptor = Cipher(self._aes, modes.CBC(iv)).encryptor()
+            text = encryptor.update(padder.update(c) + padder.finalize())
+            parts = b"\x80" + timestamp + iv + text + encryptor.finalize()
+            h = self._hmac.copy()
+            h.update(parts)
+            encoded.append(base64.urlsafe_b64encode(parts + h.finalize()))
         return encoded
 
     def inverse(self, contents: List[bytes]) -> List[bytes]:
-        f = Fernet(self.key.encode())
-        return [f.decrypt(c) for c in contents]
+        decoded = []
+        for c in contents:
+            try:
+                data = base64.urlsafe_b64decode(c)
+            except (TypeError, binascii.Error):
+                raise InvalidToken
+            if len(data) < 57 or data[0] != 0x80:
+                raise InvalidToken
+            h = self._hmac.copy()
+            h.update(data[:-32])
+            try:
+                h.verify(data[-32:])
+            except InvalidSignature:
+                raise InvalidToken
+            decryptor = Cipher(self._aes, modes.CBC(data[9:25])).decryptor()
+            unpadder = padding.PKCS7(128).unpadder()
+            text = decryptor.update(data[25:-32]) + decryptor.finalize()
+            decoded.append(unpadder.update(text) + unpadder.finalize())
+        return decoded
+
+
+class SivEncoder(Encoder):
+    # Deterministic AES-SIV, so the same path always encodes to the same name
+    # Names written by older versions are Fernet tokens, which still decode
+    key: str
+    _siv: AESSIV = PrivateAttr()
+    _legacy: FernetEncoder = PrivateAttr()
+
+    def setup(self):
+        hkdf = HKDF(hashes.SHA256(), length=64, salt=None, info=b"git-sync path")
+        self._siv = AESSIV(hkdf.derive(base64.urlsafe_b64decode(self.key.encode())))
+        self._legacy = FernetEncoder(key=self.key)
+
+    def decode(self, content: bytes) -> bytes:
+        try:
+            return self._siv.decrypt(base64.urlsafe_b64decode(content), None)
+        except (InvalidTag, ValueError):
+            pass
+        if content.startswith(b"gAAAAA"):
+            try:
+                return self._legacy.inverse([content])[0]
+            except InvalidToken:
+                pass
+        raise AssertionError(f"Cannot decode path {content!r}")
+
+    def run(self, contents: List[bytes]) -> List[bytes]:
+        return [base64.urlsafe_b64encode(self._siv.encrypt(c, None)) for c in contents]
+
+    def inverse(self, contents: List[bytes]) -> List[bytes]:
+        return [self.decode(c) for c in contents]
+
+
+class StreamEncoder(Encoder):
+    # Chunked ChaCha20-Poly1305 (STREAM construction) so files are never held whole
+    # Legacy Fernet tokens start with "g" instead of STREAM_MAGIC and still decrypt
+    key: str
+    chunk_size: int = 1 << 16
+    _aead: ChaCha20Poly1305 = PrivateAttr()
+    _legacy: FernetEncoder = PrivateAttr()
+
+    def setup(self):
+        hkdf = HKDF(hashes.SHA256(), length=32, salt=None, info=b"git-sync text")
+        key = hkdf.derive(base64.urlsafe_b64decode(self.key.encode()))
+        self._aead = ChaCha20Poly1305(key)
+        self._legacy = FernetEncoder(key=self.key)
+
+    @staticmethod
+    def nonce(prefix: bytes, i: int, is_last: bool) -> bytes:
+        return prefix + i.to_bytes(length=4, byteorder="big") + bytes([is_last])
+
+    def encrypt(self, src: BinaryIO, dst: BinaryIO):
+        prefix = os.urandom(7)
+        header = STREAM_MAGIC + prefix + self.chunk_size.to_bytes(4, byteorder="big")
+        dst.write(header)
+        chunk, i = src.read(self.chunk_size), 0
+        while True:
+            after = src.read(self.chunk_size)
+            nonce = self.nonce(prefix, i, is_last=not after)
+            dst.write(self._aead.encrypt(nonce, chunk, header))
+            if not after:
+                break
+            chunk, i = after, i + 1
+
+    def decrypt(self, src: BinaryIO, dst: BinaryIO):
+        header = src.read(len(STREAM_MAGIC) + 11)
+        if not header.startswith(STREAM_MAGIC):
+            dst.write(self._legacy.inverse([header + src.read()])[0])
+            return
+        if len(header) != len(STREAM_MAGIC) + 11:
+            raise InvalidTag
+        prefix = header[len(STREAM_MAGIC) : -4]
+        size = int.from_bytes(header[-4:], byteorder="big") + 16
+        chunk, i = src.read(size), 0
+        while True:
+            after = src.read(size)
+            nonce = self.nonce(prefix, i, is_last=not after)
+            dst.write(self._aead.decrypt(nonce, chunk, header))
+            if not after:
+                break
+            chunk, i = after, i + 1
+
+    @staticmethod
+    def transform(fn: Callable[[BinaryIO, BinaryIO], None], content: bytes) -> bytes:
+        dst = io.BytesIO()
+        fn(io.BytesIO(content), dst)
+        return dst.getvalue()
+
+    @staticmethod
+    def transform_file(
+        fn: Callable[[BinaryIO, BinaryIO], None], path_in: Path, path_out: Path
+    ):
+        # Written to a temp file first so a bad chunk never leaves partial output
+        if not path_out.parent.exists():
+            path_out.parent.mkdir(exist_ok=True, parents=True)
+        path_temp = path_out.with_name(f".{path_out.name}.{os.urandom(4).hex()}.tmp")
+        try:
+            with open(path_in, "rb") as src, open(path_temp, "xb") as dst:
+                fn(src, dst)
+            os.replace(path_temp, path_out)
+        except (InvalidTag, InvalidToken) as e:
+            path_temp.unlink(missing_ok=True)
+            raise AssertionError(f"Cannot decrypt {path_in}") from e
+        except BaseException:
+            path_temp.unlink(missing_ok=True)
+            raise
+
+    def run(self, contents: List[bytes]) -> List[bytes]:
+        return [self.transform(self.encrypt, c) for c in contents]
+
+    def inverse(self, contents: List[bytes]) -> List[bytes]:
+        return [self.transform(self.decrypt, c) for c in contents]
+
+    def run_file(self, path_in: Path, path_out: Path):
+        self.transform_file(self.encrypt, path_in, path_out)
+
+    def inverse_file(self, path_in: Path, path_out: Path):
+        self.transform_file(self.decrypt, path_in, path_out)
 
 
 def test_encoder():
@@ -51,17 +261,147 @@ def test_encoder():
     print(dict(key=encoder.key, text=text, x=x, y=y.decode(), x2=x2, y2=y2.decode()))
 
 
+def test_stream_encoder():
+    key = Fernet.generate_key().decode()
+    encoder = StreamEncoder(key=key, chunk_size=16)
+    for text in [b"", b"x" * 16, b"This is a sentence spanning several chunks"]:
+        assert encoder.inverse(encoder.run([text])) == [text]
+    legacy = FernetEncoder(key=key).run([b"Written by an older version"])
+    assert encoder.inverse(legacy) == [b"Written by an older version"]
+
+    x = encoder.run([b"This is a sentence spanning several chunks"])[0]
+    for bad in [x[:10], x[:-1], x[: len(STREAM_MAGIC) + 11 + 32], x[:-1] + b"?"]:
+        try:
+            encoder.inverse([bad])
+            assert False, bad
+        except InvalidTag:
+            pass
+    print(dict(key=key, x=x, legacy=legacy))
+
+
 class Folder(BaseModel):
     path: str
     file_patterns: List[str]
 
 
+@lru_cache(maxsize=None)
+def compile_pattern(pattern: str) -> Tuple[Pattern, Optional[int]]:
+    # Same semantics as Path.glob: "**/" spans folders, other wildcards stay in one
+    regex, i = "", 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex, i = regex + "(?:[^/]*/)*", i + 3
+        elif pattern.startswith("**", i):
+            regex, i = regex + ".*", i + 2
+        elif pattern[i] == "*":
+            regex, i = regex + "[^/]*", i + 1
+        elif pattern[i] == "?":
+            regex, i = regex + "[^/]", i + 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            j = pattern.index("]", i + 2)
+            chars = pattern[i + 1 : j].replace("\\", "\\\\")
+            regex, i = regex + "[" + re.sub("^!", "^", chars) + "]", j + 1
+        else:
+            regex, i = regex + re.escape(pattern[i]), i + 1
+    depth = None if "**" in pattern else pattern.count("/")
+    return re.compile(regex), depth
+
+
+def scan_folder(folder: Path, pattern: str) -> Set[str]:
+    # Walks with os.scandir and matches relative path strings, no per-entry Path
+    if not os.path.isdir(folder):
+        return set()
+    regex, depth = compile_pattern(pattern)
+    found = set()
+    stack = [("", os.fspath(folder), 0)]
+    while stack:
+        prefix, path, level = stack.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if depth is None or level < depth:
+                        stack.append((name + "/", entry.path, level + 1))
+                elif entry.is_file() and regex.fullmatch(name):
+                    found.add(name)
+    return found
+
+
+def read_path(path: Path) -> bytes:
+    # Unbuffered readall sizes a single read from fstat
+    with open(path, "rb", buffering=0) as f:
+        return f.readall()
+
+
+def write_path(path: Path, content: bytes):
+    if not path.parent.exists():
+        path.parent.mkdir(exist_ok=True, parents=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
 def read_paths(paths: List[Path]) -> List[bytes]:
-    contents = []
-    for p in paths:
-        with open(p, "rb") as f:
-            contents.append(f.read())
-    return contents
+    return [read_path(p) for p in paths]
+
+
+def sync_filesystem(path: Path):
+    # Single flush of the filesystem containing path, instead of per file
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "syncfs") or libc.syncfs(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)
+
+
+class FolderWatcher(BaseModel):
+    # Blocks on inotify until files change, instead of waking up every interval
+    folders: List[Path]
+    debounce: float = 0.5
+    _inotify: Optional["INotify"] = PrivateAttr(default=None)
+    _wd_to_path: Dict[int, Path] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        if INotify is not None:
+            self._inotify = INotify()
+            try:
+                for folder in self.folders:
+                    self.watch(folder)
+            except OSError as e:  # Eg too many folders for max_user_watches
+                self.stop(e)
+
+    def stop(self, error: OSError):
+        print(dict(watch_error=error, fallback="polling"))
+        self._inotify.close()
+        self._inotify = None
+
+    def watch(self, folder: Path):
+        mask = flags.MODIFY | flags.CREATE | flags.DELETE | flags.MOVED_TO
+        mask |= flags.MOVED_FROM
+        for root, _, _ in os.walk(folder):
+            try:
+                self._wd_to_path[self._inotify.add_watch(root, mask)] = Path(root)
+            except FileNotFoundError:  # Removed since os.walk listed it
+                pass
+
+    def wait(self, timeout: float) -> bool:
+        if self._inotify is None:
+            time.sleep(timeout)
+            return True
+        events = self._inotify.read(timeout=int(timeout * 1000))
+        if events:
+            time.sleep(self.debounce)
+            events += self._inotify.read(timeout=0)
+        try:
+            for e in events:
+                if e.mask & flags.ISDIR and e.mask & (flags.CREATE | flags.MOVED_TO):
+                    self.watch(self._wd_to_path[e.wd] / e.name)
+        except OSError as e:
+            self.stop(e)
+            return True
+        return bool(events)
 
 
 class Synchronizer(BaseModel):
@@ -71,70 +411,153 @@ class Synchronizer(BaseModel):
     text_encoder: Encoder
     path_encoder: Encoder
     validate_encoding: bool
-    path_to_hash: Dict[Path, str] = {}
+    debug_validate: bool = False
+    is_encoded_in: bool = False
+    path_cache: Optional[Path] = None
+    path_to_meta: Dict[str, Tuple[int, int, str]] = {}
+    _encode_cache: Dict[str, str] = PrivateAttr(default_factory=dict)
+    _decode_cache: Dict[str, str] = PrivateAttr(default_factory=dict)
+    _pool: ThreadPoolExecutor = PrivateAttr(
+        default_factory=lambda: ThreadPoolExecutor(min(32, (os.cpu_count() or 1) * 4))
+    )
+    _process_pool: Optional[ProcessPoolExecutor] = PrivateAttr(default=None)
 
-    @staticmethod
-    def glob(pattern: str, folder: Path) -> Set[Path]:
-        depth = len(folder.parts)
-        return set([Path(*p.parts[depth:]) for p in folder.glob(pattern)])
+    def __init__(self, **data):
+        super().__init__(**data)
+        if self.path_cache is not None and self.path_cache.exists():
+            with open(self.path_cache) as f:
+                self.path_to_meta = {k: tuple(v) for k, v in json.load(f).items()}
+        if self.validate_encoding:
+            self.validate_canary()
+
+    def validate_canary(self):
+        # Round-trip check once at startup, per-tick checks are behind debug_validate
+        self.path_encoder.check_round_trip(b"git-sync/canary.txt")
+        self.text_encoder.check_round_trip(b"git-sync canary")
+
+    def save_cache(self):
+        if self.path_cache is not None:
+            self.path_cache.parent.mkdir(exist_ok=True, parents=True)
+            with open(self.path_cache, "w") as f:
+                json.dump(self.path_to_meta, f)
 
     @staticmethod
-    def read_hash(path: Path) -> str:
-        with open(path, "rb") as f:
-            return hashlib.md5(f.read()).hexdigest()
+    def glob(pattern: str, folder: Path) -> Set[str]:
+        return scan_folder(folder, pattern)
 
-    def add_files(self, paths_map: Dict[Path, Path], folder_in: Path, folder_out: Path):
-        texts = read_paths([folder_in / p for p in paths_map.keys()])
-        encoded = self.text_encoder.run(texts)
+    @staticmethod
+    def read_hash(path: Path, chunk_size: int = 1 << 20) -> str:
+        h = blake3.blake3()
+        with open(path, "rb", buffering=0) as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def read_meta(self, path: Path, key: str) -> Tuple[int, int, str]:
+        # Quick check like rsync: only re-hash if mtime or size changed
+        stat = path.stat()
+        meta = self.path_to_meta.get(key)
+        if meta is not None and meta[:2] == (stat.st_mtime_ns, stat.st_size):
+            return meta
+        return stat.st_mtime_ns, stat.st_size, self.read_hash(path)
+
+    def get_pool(self, size: int) -> Union[ThreadPoolExecutor, ProcessPoolExecutor]:
+        # Large batches are encoded across cores, small ones aren't worth the pickling
+        if size < PROCESS_POOL_SIZE:
+            return self._pool
+        if self._process_pool is None:
+            # Spawned, as forking while the thread pool is running can deadlock
+            context = multiprocessing.get_context("spawn")
+            self._process_pool = ProcessPoolExecutor(os.cpu_count(), mp_context=context)
+        return self._process_pool
+
+    def add_files(
+        self,
+        paths_map: Dict[str, str],
+        folder_in: Path,
+        folder_out: Path,
+        size: int = 0,
+    ):
+        paths_in = [folder_in / p for p in paths_map]
         paths_out = [folder_out / p for p in paths_map.values()]
-        for i, p in enumerate(paths_out):
-            if not p.parent.exists():
-                p.parent.mkdir(exist_ok=True, parents=True)
-            with open(p, "wb") as f:
-                f.write(encoded[i])
-        if self.validate_encoding:
+        pool = self.get_pool(size)
+        chunksize = max(1, len(paths_in) // (4 * (os.cpu_count() or 1)))
+        list(
+            pool.map(
+                self.text_encoder.run_file, paths_in, paths_out, chunksize=chunksize
+            )
+        )
+        if self.debug_validate:
+            texts = read_paths(paths_in)
             assert self.text_encoder.inverse(read_paths(paths_out)) == texts
 
-    def encode_paths(self, paths: List[Path]) -> List[Path]:
-        encoded = self.path_encoder.run([str(p).encode() for p in paths])
-        paths_out = [Path(e.decode()) for e in encoded]
-        if self.validate_encoding:
-            assert self.decode_paths(paths_out) == paths
+    @staticmethod
+    def run_cached(fn: Callable, paths: List[str], cache: Dict[str, str]) -> List[str]:
+        # Only paths not seen on a previous tick are converted to bytes and encoded
+        misses = [p for p in paths if p not in cache]
+        if misses:
+            misses = list(dict.fromkeys(misses))
+            outputs = fn([p.encode() for p in misses])
+            cache.update(zip(misses, [o.decode() for o in outputs]))
+        if len(cache) > 2 * len(paths):
+            keep = {p: cache[p] for p in paths}
+            cache.clear()
+            cache.update(keep)
+        return [cache[p] for p in paths]
+
+    def encode_paths(self, paths: List[str]) -> List[str]:
+        if not self.debug_validate:
+            return self.run_cached(self.path_encoder.run, paths, self._encode_cache)
+        misses = [p for p in paths if p not in self._encode_cache]
+        paths_out = self.run_cached(self.path_encoder.run, paths, self._encode_cache)
+        if misses:
+            assert self.decode_paths([self._encode_cache[p] for p in misses]) == misses
         return paths_out
 
-    def decode_paths(self, paths: List[Path]) -> List[Path]:
-        decoded = self.path_encoder.inverse([str(p).encode() for p in paths])
-        paths_out = [Path(d.decode()) for d in decoded]
-        return paths_out
+    def decode_paths(self, paths: List[str]) -> List[str]:
+        return self.run_cached(self.path_encoder.inverse, paths, self._decode_cache)
+
+    def match(self, name: str) -> bool:
+        return any(compile_pattern(p)[0].fullmatch(name) for p in self.patterns)
+
+    def list_paths(self, folder: Path, is_encoded: bool) -> Set[str]:
+        # Encoded paths are flat names, so patterns only apply to plain paths
+        if is_encoded:
+            return self.glob("*", folder)
+        return set().union(*[self.glob(p, folder) for p in self.patterns])
 
-    def run_pattern(self, pattern: str, folder_in: Path, folder_out: Path):
-        paths_in = sorted(self.glob(pattern, folder_in))
-        paths_out = sorted(self.glob("*", folder_out))
+    def run(self):
+        is_changed = False
+        paths_in = sorted(self.list_paths(self.folder_in, self.is_encoded_in))
         encoded = self.encode_paths(paths_in)
-        decoded = self.decode_paths(paths_out)
-        is_match = [p.resolve().match(pattern) for p in decoded]
-        decoded = [p for i, p in enumerate(decoded) if is_match[i]]
-        paths_out = [p for i, p in enumerate(paths_out) if is_match[i]]
         paths_map = {p: encoded[i] for i, p in enumerate(paths_in)}
-        paths_map.update({decoded[i]: p for i, p in enumerate(paths_out)})
-
-        for p in set(decoded) - set(paths_in):
-            os.remove(folder_out / paths_map[p])
-            self.path_to_hash.pop(p)
+        if self.is_encoded_in:
+            paths_map = {k: v for k, v in paths_map.items() if self.match(v)}
+        paths_out = self.list_paths(self.folder_out, not self.is_encoded_in)
+        encoded_set = set(paths_map.values())
+
+        for p in paths_out - encoded_set:
+            os.remove(self.folder_out / p)
+            self.path_to_meta.pop(p, None)
+            is_changed = True
             print(dict(remove=p))
 
-        to_add: Dict[Path, Path] = {}
-        for p in paths_in:
-            hash_in = self.read_hash(folder_in / p)
-            if self.path_to_hash.get(p, "") != hash_in:
-                to_add[p] = paths_map[p]
-                self.path_to_hash[p] = hash_in
-                print(dict(add=p))
-        self.add_files(to_add, folder_in, folder_out)
-
-    def run(self):
-        for p in self.patterns:
-            self.run_pattern(p, self.folder_in, self.folder_out)
+        to_add: Dict[str, str] = {}
+        size_add = 0
+        files_in = [self.folder_in / p for p in paths_map]
+        metas = self._pool.map(self.read_meta, files_in, paths_map.values())
+        for (p_in, p), meta in zip(paths_map.items(), metas):
+            meta_old = self.path_to_meta.get(p)
+            if meta_old is None or meta_old[2] != meta[2] or p not in paths_out:
+                to_add[p_in] = p
+                size_add += meta[1]
+                print(dict(add=p if self.is_encoded_in else p_in))
+            if meta_old != meta:
+                self.path_to_meta[p] = meta
+                is_changed = True
+        self.add_files(to_add, self.folder_in, self.folder_out, size=size_add)
+        if is_changed:
+            self.save_cache()
 
 
 class Config(BaseModel):
@@ -151,52 +574,76 @@ class ShellOutput(BaseModel):
     is_success: bool
 
 
-def run_shell(command: str) -> ShellOutput:
-    process = subprocess.run(command.split(), capture_output=True)
+def run_shell(command: List[str], capture: bool = True) -> ShellOutput:
+    # Without capture, stdout is discarded and only stderr is kept for errors
+    stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+    process = subprocess.run(command, stdout=stdout, stderr=subprocess.PIPE)
     return ShellOutput(
-        text=process.stdout.decode(),
+        text=process.stdout.decode() if capture else "",
         error=process.stderr.decode(),
         is_success=process.returncode == 0,
     )
 
 
 class GitRepo(BaseModel):
+    # Local index/commit operations run in-process via libgit2, network ones via git
     root: str
+    _repo: Optional[pygit2.Repository] = PrivateAttr(default=None)
 
     def clone(self, url: str):
         if not Path(self.root).exists():
-            command = f"git clone {url} {self.root}"
-            output = run_shell(command)
+            output = run_shell(["git", "clone", url, self.root], capture=False)
             assert output.is_success
 
     @property
-    def prefix(self) -> str:
+    def prefix(self) -> List[str]:
         path_full = Path(self.root).resolve(strict=True)
-        return f"git -C {path_full}"
+        return ["git", "-C", str(path_full)]
+
+    @property
+    def repo(self) -> pygit2.Repository:
+        if self._repo is None:
+            self._repo = pygit2.Repository(str(Path(self.root).resolve(strict=True)))
+        return self._repo
 
     def diff_staged(self) -> str:
-        output = run_shell(f"{self.prefix} diff --staged")
-        assert output.is_success
-        return output.text
+        index = self.repo.index
+        index.read()
+        if self.repo.head_is_unborn:
+            tree = self.repo.get(self.repo.TreeBuilder().write())
+        else:
+            tree = self.repo.head.peel(pygit2.Tree)
+        return index.diff_to_tree(tree).patch or ""
 
     def add(self, paths: List[Path]):
-        for p in paths:
-            path_full = p.resolve(strict=True)
-            output = run_shell(f"{self.prefix} add --all {path_full}")
-            assert output.is_success
+        root = Path(self.repo.workdir).resolve(strict=True)
+        specs = [str(p.resolve(strict=True).relative_to(root)) for p in paths]
+        specs = [s if s != "." else "*" for s in specs]
+        index = self.repo.index
+        index.read()
+        index.add_all(specs)
+        index.write()
 
     def commit(self, message: str):
         assert message
-        assert "'" not in message
-        output = run_shell(f"{self.prefix} commit --message '{message}'")
-        assert output.is_success
+        index = self.repo.index
+        index.read()
+        parents = [] if self.repo.head_is_unborn else [self.repo.head.target]
+        signature = self.repo.default_signature
+        tree = index.write_tree()
+        self.repo.create_commit("HEAD", signature, signature, message, tree, parents)
 
     def push(self):
-        output = run_shell(f"{self.prefix} push")
+        output = run_shell([*self.prefix, "push"], capture=False)
+        assert output.is_success
+
+    def remote_head(self) -> str:
+        output = run_shell([*self.prefix, "ls-remote", "origin", "HEAD"])
         assert output.is_success
+        return output.text.split()[0] if output.text else ""
 
     def pull(self):
-        output = run_shell(f"{self.prefix} pull")
+        output = run_shell([*self.prefix, "pull", "--ff-only"], capture=False)
         assert output.is_success
 
 